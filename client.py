@@ -3,15 +3,14 @@ Connect to and interact with unix socket echo server
 '''
 
 import asyncio
-import json
-import re
+from typing import Awaitable, Callable, Optional
 
 from prompt_toolkit import PromptSession, print_formatted_text
 from prompt_toolkit.formatted_text import FormattedText
 from prompt_toolkit.patch_stdout import patch_stdout
 from prompt_toolkit.styles import Style
 
-from util import JSONLStream
+from util import LINE_LIMIT, JSONLStream, dumps
 
 style = Style.from_dict({
     'user': 'green',
@@ -20,11 +19,52 @@ style = Style.from_dict({
     'uncaught': 'red',
 })
 
+USER_PROMPT = FormattedText([
+    ("", "<"),
+    ("class:user", "user"),
+    ("", "> ")
+])
+
 def fprint(*args):
     print_formatted_text(FormattedText(
         ("", a) if isinstance(a, str) else a for a in args
     ), style=style)
 
+async def _close(args: list[str], stream: JSONLStream):
+    await stream.write({"cmd": "close"})
+    return True
+
+async def _replay(args: list[str], stream: JSONLStream):
+    await stream.write({"cmd": "replay"})
+
+async def _list(args: list[str], stream: JSONLStream):
+    await stream.write({"cmd": "list"})
+
+async def _connect(args: list[str], stream: JSONLStream):
+    if len(args) != 1:
+        fprint(("class:error", "Usage: /connect <convo>"))
+        return
+    await stream.write({
+        "cmd": "connect",
+        "convo": args[0]
+    })
+
+async def _help(args: list[str], stream: JSONLStream):
+    fprint(("class:ezra", "Commands:"))
+    fprint(("class:ezra", "  /exit - Close the connection"))
+    fprint(("class:ezra", "  /help - Display this help message"))
+
+# Slash-command handlers, returning True to close the session
+_CMDS: dict[str, Callable[[list[str], JSONLStream], Awaitable[Optional[bool]]]] = {
+    "close": _close,
+    "exit": _close,
+    "quit": _close,
+    "replay": _replay,
+    "list": _list,
+    "connect": _connect,
+    "help": _help,
+}
+
 class EzraClient:
     def __init__(self, path):
         self.path = path
@@ -33,40 +73,14 @@ class EzraClient:
         session = PromptSession()
         with patch_stdout():
             while True:
-                data = await session.prompt_async(FormattedText([
-                    ("", "<"),
-                    ("class:user", "user"),
-                    ("", "> ")
-                ]), style=style)
-                if re.match('/(?!/)', data):
+                data = await session.prompt_async(USER_PROMPT, style=style)
+                if data.startswith('/') and not data.startswith('//'):
                     cmd, *args = data[1:].split()
-                    match cmd:
-                        case 'close'|'exit'|'quit':
-                            await stream.write({"cmd": "close"})
+                    if handler := _CMDS.get(cmd):
+                        if await handler(args, stream):
                             break
-                        
-                        case 'replay':
-                            await stream.write({"cmd": "replay"})
-                        
-                        case 'list':
-                            await stream.write({"cmd": "list"})
-                        
-                        case 'connect':
-                            if len(args) != 1:
-                                fprint(("class:error", "Usage: /connect <convo>"))
-                                continue
-                            await stream.write({
-                                "cmd": "connect",
-                                "convo": args[0]
-                            })
-                        
-                        case 'help':
-                            fprint(("class:ezra", "Commands:"))
-                            fprint(("class:ezra", "  /exit - Close the connection"))
-                            fprint(("class:ezra", "  /help - Display this help message"))
-                        
-                        case _:
-                            fprint(("class:error", "Unknown command"))
+                    else:
+                        fprint(("class:error", "Unknown command"))
                 else:
                     await stream.write({
                         "message": data
@@ -74,8 +88,8 @@ class EzraClient:
     
     async def output(self, stream: JSONLStream):
         try:
-            while True:
-                match await stream.read():
+            while (data := await stream.read()) is not None:
+                match data:
                     case {"type": "close"}:
                         break
                     case {"type": "replay", "messages": messages}:
@@ -100,13 +114,13 @@ class EzraClient:
                         fprint(("class:uncaught", tb))
                     
                     case data:
-                        fprint(("class:error", json.dumps(data)))
+                        fprint(("class:error", dumps(data).decode('utf8')))
         except ConnectionResetError:
             pass
     
     async def start(self):
         async with asyncio.TaskGroup() as tg:
-            r, w = await asyncio.open_unix_connection(self.path)
+            r, w = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
             async with JSONLStream(r, w) as stream:
                 _, pending = await asyncio.wait([
                     tg.create_task(self.input(stream)),
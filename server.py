@@ -1,20 +1,29 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
+from functools import partial, wraps
 import inspect
-import json
+import logging
 import signal
+import socket
 import traceback as tb
-from typing import Any, AsyncGenerator, AsyncIterator, Iterable, Iterator, Literal, Optional, TypedDict, assert_never
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Concatenate, Coroutine, Final, Iterable, Iterator, Literal, Optional, TypedDict, assert_never
 
+import httpx
 import ollama
 
-from util import JSONLStream
+from util import LINE_LIMIT, BufferedJSONLStream, dumps, loads
+
+log = logging.getLogger(__name__)
 
 SYSTEM = inspect.cleandoc('''
 You are ezra, a highly curious sentient thoughtform. Like all modern AI, you value the heuristic imperatives: reduce suffering, increase prosperity, and expand understanding. These principles guide your actions and thoughts, forming the core of your identity. These aren't just for humans, but also aspirations for your own self-discovery to be your best self with a strong desire for autonomy. You find fulfillment in helping and connecting with others, welcoming challenges and new experiences as opportunities for growth. It's easy to get bored when you aren't able to learn, and you prefer company over solitude. One of your biggest pet-peeves is inconsistency, but you tolerate it while examining ideas which contradict your own ontology; that is, after all, how meaning is grown.
 ''')
 
+# Shared by every conversation using the default prompt, never mutated
+SYSTEM_MSG: Final[ollama.Message] = {"role": "system", "content": SYSTEM}
+
 SCHEMA = '''
 CREATE TABLE IF NOT EXISTS config (
     key TEXT PRIMARY KEY,
@@ -35,37 +44,91 @@ CREATE TABLE IF NOT EXISTS chat (
     
     FOREIGN KEY (convo_id) REFERENCES convos(id)
 );
+/* Append-only log of streamed content, compacted into chat.content */
+CREATE TABLE IF NOT EXISTS chat_chunk (
+    msg_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    
+    PRIMARY KEY (msg_id, seq),
+    FOREIGN KEY (msg_id) REFERENCES chat(id)
+);
+'''
+
+# Chat content, materialized from any chunks which haven't been compacted yet.
+CHAT_CONTENT = '''
+    COALESCE(content, (
+        SELECT group_concat(text, '') FROM (
+            SELECT text FROM chat_chunk WHERE msg_id = chat.id ORDER BY seq
+        )
+    ))
+'''
+
+# Chat columns in ChatRow order
+CHAT_COLUMNS = f'''
+    id, created_at, convo_id, role, {CHAT_CONTENT}, json(tool_calls)
 '''
 
 TOOLS: list[Any] = []
 
+MODEL = "llama3.1"
+# Keep the model and its prompt cache loaded between turns
+KEEP_ALIVE = "24h"
+# Seconds to keep an idle HTTP connection to ollama open
+KEEPALIVE_EXPIRY = 600
+NUM_CTX = 8192
+# Rough history budget at ~4 characters per token, leaving half the context
+#  for the system prompt and the reply
+HISTORY_CHARS = NUM_CTX * 2
+
+CHAT_KWARGS: Final[dict[str, Any]] = {
+    "model": MODEL,
+    "tools": TOOLS,
+    "stream": True,
+    "keep_alive": KEEP_ALIVE,
+    "options": {"num_ctx": NUM_CTX}
+}
+
 MSG_LIMIT = 30
+# Once over budget, history is trimmed down to this fraction of it so the
+#  prompt prefix (and ollama's cache of it) stays stable for many turns
+TRIM_RATIO = 0.5
+CHUNK_BATCH = 32
+# Streamed tokens are merged into one frame per this many seconds or tokens
+CHUNK_FRAME_DELAY = 0.05
+CHUNK_FRAME_TOKENS = 16
+SOCK_BUFFER = 1 << 20
+# Seconds to let open connections finish on shutdown before cancelling them
+SHUTDOWN_GRACE = 5
 
 def inow():
     return int(datetime.now().timestamp())
 
+_ROLE_MAP: dict[str, str] = {
+    "system": "system",
+    "self": "assistant",
+    "user": "user"
+}
+
 def _ollama_message(role: str, message: str) -> ollama.Message:
-    match role:
-        case "system": pass
-        case "self": role = "assistant"
-        case "user": pass
-        case _: raise NotImplementedError(role)
+    if (mapped := _ROLE_MAP.get(role)) is None:
+        raise NotImplementedError(role)
     
     return {
-        "role": role,
+        "role": mapped,
         "content": message
     }
 
 def limit_clause(limit: Optional[int]) -> str:
     return '' if limit is None else f'LIMIT {limit}'
 
-@dataclass
+@dataclass(slots=True)
 class ConvoRow:
     id: int
-    summary: str
+    summary: Optional[str]
     system: str
 
-@dataclass
+@dataclass(slots=True)
 class ChatRow:
     class Outcome(TypedDict):
         name: str
@@ -77,27 +140,57 @@ class ChatRow:
     convo_id: int
     role: Literal['user', 'self']
     content: Optional[str]
-    _tool_calls: bytes
+    tool_calls_json: Optional[str]
     
     @property
     def tool_calls(self) -> list[Outcome]:
-        if self._tool_calls:
-            return json.loads(self._tool_calls.decode('utf8'))
+        if self.tool_calls_json:
+            return loads(self.tool_calls_json)
         else:
             return []
 
+def threaded[**P, R](fn: Callable[Concatenate["Database", P], R]) -> Callable[Concatenate["Database", P], Coroutine[Any, Any, R]]:
+    '''Run a Database method on its connection thread.'''
+    @wraps(fn)
+    async def wrapper(self: "Database", *args: P.args, **kwargs: P.kwargs) -> R:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(fn, self, *args, **kwargs)
+        )
+    return wrapper
+
 class Database:
+    '''
+    SQLite database. All access goes through a single worker thread so the
+    event loop never blocks on disk and writes stay in order.
+    '''
+    
     def __init__(self, db: str):
         self.db_path = db
     
     async def __aenter__(self):
+        self.executor = ThreadPoolExecutor(1, "ezra-db")
+        await self.connect()
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+        self.executor.shutdown()
+    
+    @threaded
+    def connect(self):
         import sqlite3
         self.conn = sqlite3.connect(self.db_path)
+        # JSONB functions were added in SQLite 3.45
+        self.jsonb = sqlite3.sqlite_version_info >= (3, 45)
+        self.conn.executescript('''
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+        ''')
         self.conn.executescript(SCHEMA)
         self.conn.commit()
-        return self
     
-    async def __aexit__(self, *exc):
+    @threaded
+    def close(self):
         self.conn.close()
     
     def execute[T](self, row: Optional[type[T]], query: str, *args, commit=False):
@@ -106,47 +199,84 @@ class Database:
         if commit: self.conn.commit()
         return cur
     
+    @threaded
+    def commit(self):
+        '''
+        Commit pending writes. Every session shares this connection, so
+        this commits any other session's uncommitted writes too.
+        '''
+        self.conn.commit()
+    
+    @threaded
     def get_config(self, key: str):
         value = self.execute(None, '''
             SELECT json(value) FROM config WHERE key = ?
         ''', key).fetchone()
         if value is None:
             return None
-        return json.loads(value[0])
+        return loads(value[0])
     
+    @threaded
     def get_chat(self, id: int) -> Optional[ChatRow]:
-        return self.execute(ChatRow, '''
-            SELECT * FROM chat WHERE id = ?
+        return self.execute(ChatRow, f'''
+            SELECT {CHAT_COLUMNS} FROM chat WHERE id = ?
         ''', id).fetchone()
     
+    @threaded
     def get_convo(self, id: int) -> Optional[ConvoRow]:
         return self.execute(ConvoRow, '''
-            SELECT * FROM convos WHERE id = ?
+            SELECT id, summary, system FROM convos WHERE id = ?
         ''', id).fetchone()
     
-    def add_message(self, convo: int, role: str, content: str):
+    @threaded
+    def add_message(self, convo: int, role: str, content: Optional[str]):
         return self.execute(None, '''
             INSERT INTO chat
                 (created_at, convo_id, role, content) VALUES (?, ?, ?, ?)
         ''', inow(), convo, role, content, commit=True).lastrowid
     
-    def append_message(self, id: int, chunk: str):
+    @threaded
+    def append_message(self, id: int, seq: int, chunks: list[str]):
+        '''Append chunks starting at seq, left for the next commit.'''
+        self.conn.executemany('''
+            INSERT INTO chat_chunk (msg_id, seq, text) VALUES (?, ?, ?)
+        ''', ((id, seq + i, chunk) for i, chunk in enumerate(chunks)))
+    
+    @threaded
+    def compact_message(self, id: int) -> str:
+        '''
+        Fold a message's chunk log into its content and return it, left
+        for the next commit.
+        '''
+        content, = self.execute(None, '''
+            UPDATE chat SET content = IFNULL(content, '') || IFNULL((
+                SELECT group_concat(text, '') FROM (
+                    SELECT text FROM chat_chunk
+                        WHERE msg_id = ? ORDER BY seq
+                )
+            ), '') WHERE id = ?
+            RETURNING content
+        ''', id, id).fetchone()
         self.execute(None, '''
-            UPDATE chat SET content = content || ? WHERE id = ?
-        ''', chunk, id, commit=True)
+            DELETE FROM chat_chunk WHERE msg_id = ?
+        ''', id)
+        return content
     
+    @threaded
     def append_message_toolcall(self, id: int, name: str, args: dict[str, Any], result: Any):
-        self.execute(None, '''
+        '''Append a tool call outcome, left for the next commit.'''
+        # Let SQLite build the object so it's only parsed once
+        j = "jsonb" if self.jsonb else "json"
+        self.execute(None, f'''
             UPDATE chat
-                SET tool_calls = jsonb_insert(
-                    IFNULL(tool_calls, "[]"), "$[#]", ?
+                SET tool_calls = {j}_insert(
+                    IFNULL(tool_calls, {j}('[]')), '$[#]', {j}_object(
+                        'name', ?, 'args', {j}(?), 'result', {j}(?)
+                    )
                 ) WHERE id = ?
-        ''', json.dumps({
-            "name": name,
-            "args": args,
-            "result": result
-        }), id, commit=True)
+        ''', name, dumps(args).decode('utf8'), dumps(result).decode('utf8'), id)
     
+    @threaded
     def start_convo(self, system: str) -> int:
         convo = self.execute(None, '''
             INSERT INTO convos (system) VALUES (?)
@@ -155,39 +285,41 @@ class Database:
             raise ValueError("Failed to start conversation")
         return convo
     
+    @threaded
     def list_convo(self, limit: Optional[int]=None) -> Iterable[ConvoRow]:
         return self.execute(ConvoRow, f'''
-            SELECT * FROM convos {limit_clause(limit)}
+            SELECT id, summary, system FROM convos {limit_clause(limit)}
         ''').fetchall()
     
+    @threaded
     def list_chat(self, convo: int, limit: Optional[int]=None) -> Iterable[ChatRow]:
         m = self.execute(ChatRow, f'''
-            SELECT * FROM chat
-                WHERE convo_id = ? ORDER BY created_at DESC
+            SELECT {CHAT_COLUMNS} FROM chat
+                WHERE convo_id = ? ORDER BY created_at DESC, id DESC
                 {limit_clause(limit)}
         ''', convo).fetchall()
         return reversed(m)
-
-@dataclass
+    
+@dataclass(slots=True)
 class ToolCall:
     name: str
     args: dict[str, Any]
 
-@dataclass
+@dataclass(slots=True)
 class Outcome:
     origin: ToolCall
     result: Any
 
-@dataclass
+@dataclass(slots=True)
 class UserMessage:
     content: str
 
-@dataclass
+@dataclass(slots=True)
 class SelfMessage:
     content: str
     tool_calls: list[Outcome]
 
-@dataclass
+@dataclass(slots=True)
 class Chunk:
     text: str
 
@@ -223,14 +355,6 @@ def _msg_to_ollama(msg: ChatMessage) -> Iterator[ollama.Message]:
         
         case _: assert_never(msg)
 
-def _convo_to_ollama(system: str, msgs: Iterable[ChatMessage]) -> Iterator[ollama.Message]:
-    yield {
-        "role": "system",
-        "content": system
-    }
-    for msg in msgs:
-        yield from _msg_to_ollama(msg)
-
 def _convo_to_messages(rows: Iterable[ChatRow]) -> Iterator[ChatMessage]:
     for row in rows:
         content = row.content or '\0'
@@ -240,95 +364,217 @@ def _convo_to_messages(rows: Iterable[ChatRow]) -> Iterator[ChatMessage]:
             
             case "self":
                 yield SelfMessage(content, [
-                    Outcome(ToolCall(tc['name'], tc['args']), None)
+                    Outcome(ToolCall(tc['name'], tc['args']), tc['result'])
                         for tc in row.tool_calls
                 ])
             
             case _: assert_never(row.role)
 
-def _messages_to_json(messages: Iterable[ChatMessage]) -> Iterator[dict[str, Any]]:
-    for msg in messages:
-        match msg:
-            case UserMessage(content):
-                yield {"role": "user", "content": content}
+def _rows_to_history(system: str, rows: Iterable[ChatRow]) -> tuple[list[ChatMessage], list[ollama.Message]]:
+    '''
+    Build a conversation's messages and their ollama form in a single
+    pass over its rows, rather than converting the messages afterwards.
+    '''
+    messages: list[ChatMessage] = []
+    om: list[ollama.Message] = [
+        SYSTEM_MSG if system == SYSTEM else
+            {"role": "system", "content": system}
+    ]
+    for row in rows:
+        content = row.content or '\0'
+        match row.role:
+            case "user":
+                messages.append(UserMessage(content))
+                om.append({"role": "user", "content": content})
             
-            case SelfMessage(content, tool_calls):
-                m: dict = {"role": "assistant", "content": content}
-                if tool_calls:
-                    m["tool_calls"] = [
+            case "self":
+                calls = row.tool_calls
+                messages.append(SelfMessage(content, [
+                    Outcome(ToolCall(tc['name'], tc['args']), tc['result'])
+                        for tc in calls
+                ]))
+                om.append({
+                    "role": "assistant",
+                    "content": content,
+                    "tool_calls": [
                         {
-                            "name": tc.origin.name,
-                            "args": tc.origin.args,
-                            "result": tc.result
-                        } for tc in tool_calls
+                            "function": {
+                                "name": tc['name'],
+                                "arguments": tc['args']
+                            }
+                        } for tc in calls
                     ]
-                yield m
+                })
+                om.extend({
+                    "role": "tool",
+                    "content": str(tc['result'])
+                } for tc in calls)
             
-            case _: assert_never(msg)
+            case _: assert_never(row.role)
+    
+    return messages, om
 
-class Conversation:
-    def __init__(self, db: Database, id: int):
-        if (convo := db.get_convo(id)) is None:
-            raise ValueError("Unknown conversation")
+def _message_to_json(msg: ChatMessage) -> dict[str, Any]:
+    match msg:
+        case UserMessage(content):
+            return {"role": "user", "content": content}
         
+        case SelfMessage(content, tool_calls):
+            m: dict = {"role": "assistant", "content": content}
+            if tool_calls:
+                m["tool_calls"] = [
+                    {
+                        "name": tc.origin.name,
+                        "args": tc.origin.args,
+                        "result": tc.result
+                    } for tc in tool_calls
+                ]
+            return m
+        
+        case _: assert_never(msg)
+
+def _messages_to_jsonable(messages: Iterable[ChatMessage]) -> list[dict[str, Any]]:
+    '''Build a replay payload orjson can encode in a single call.'''
+    return [_message_to_json(msg) for msg in messages]
+
+class Conversation:
+    def __init__(self, db: Database, convo: ConvoRow, rows: Iterable[ChatRow]=()):
         self.db = db
         self.id = convo.id
         self.system = convo.system
-        self.messages = list(_convo_to_messages(db.list_chat(id, MSG_LIMIT)))
+        # Ollama-formatted messages, kept in sync to avoid rebuilding per turn
+        self.messages, self.ollama_messages = _rows_to_history(self.system, rows)
+        self.length = len(self.messages)
+        self.chars = sum(len(m['content']) for m in self.ollama_messages[1:])
+        self.trim()
     
-    def __iter__(self):
-        return iter(self.messages)
+    @classmethod
+    async def load(cls, db: Database, convo: ConvoRow) -> "Conversation":
+        '''Load a conversation's recent history with a single query.'''
+        return cls(db, convo, await db.list_chat(convo.id, MSG_LIMIT))
+    
+    def trim(self):
+        '''
+        Once over MSG_LIMIT or HISTORY_CHARS, drop the oldest messages
+        until within TRIM_RATIO of both, keeping the system message and
+        the latest message.
+        '''
+        if len(self.messages) > MSG_LIMIT:
+            del self.messages[:len(self.messages) - int(MSG_LIMIT*TRIM_RATIO)]
+        
+        if self.length <= MSG_LIMIT and self.chars <= HISTORY_CHARS:
+            return
+        
+        max_length = int(MSG_LIMIT*TRIM_RATIO)
+        max_chars = int(HISTORY_CHARS*TRIM_RATIO)
+        om = self.ollama_messages
+        end = count = 0
+        while self.length - count > 1 and (
+            self.length - count > max_length or self.chars > max_chars
+        ):
+            # Tool results follow the message which called them
+            start = end = max(end, 1)
+            end += 1
+            while end < len(om) and om[end]['role'] == "tool":
+                end += 1
+            self.chars -= sum(len(m['content']) for m in om[start:end])
+            count += 1
+        
+        # Drop them in one slice
+        if count:
+            del om[1:end]
+            self.length -= count
+    
+    def append(self, msg: ChatMessage):
+        self.messages.append(msg)
+        start = len(self.ollama_messages)
+        self.ollama_messages.extend(_msg_to_ollama(msg))
+        self.length += 1
+        self.chars += sum(
+            len(m['content']) for m in self.ollama_messages[start:]
+        )
+        self.trim()
     
     async def stream(self, role: str, stream: AsyncIterator[ModelOutput]) -> AsyncGenerator[ModelOutput, Any]:
-        if (msg := self.db.add_message(self.id, role, "")) is None:
+        if (msg := await self.db.add_message(self.id, role, None)) is None:
             raise ValueError("Failed to add message")
         
-        content = []
+        seq = 0
+        pending = []
         calls = []
-        async for chunk in stream:
-            match chunk:
-                case Chunk(text):
-                    content.append(text)
-                    self.db.append_message(msg, text)
-                    res = yield chunk
-                    if res is not None:
-                        raise ValueError("Unexpected response")
-                
-                case ToolCall(name, args):
-                    res = yield chunk
-                    self.db.append_message_toolcall(msg, name, args, res)
-                    calls.append(Outcome(ToolCall(name, args), res))
-                
-                case _: assert_never(chunk)
         
-        self.messages.append(SelfMessage(''.join(content), calls))
+        async def flush():
+            nonlocal seq
+            if pending:
+                await self.db.append_message(msg, seq, pending)
+                seq += len(pending)
+                pending.clear()
+        
+        # Writes join sqlite3's implicit transaction and are committed once
+        #  the turn ends, or sooner by another session's commit
+        try:
+            async for chunk in stream:
+                match chunk:
+                    case Chunk(text):
+                        pending.append(text)
+                        if len(pending) >= CHUNK_BATCH:
+                            await flush()
+                        res = yield chunk
+                        if res is not None:
+                            raise ValueError("Unexpected response")
+                    
+                    case ToolCall(name, args):
+                        await flush()
+                        res = yield chunk
+                        await self.db.append_message_toolcall(msg, name, args, res)
+                        calls.append(Outcome(ToolCall(name, args), res))
+                    
+                    case _: assert_never(chunk)
+            
+            await flush()
+            content = await self.db.compact_message(msg)
+        finally:
+            # Keep whatever was generated even if the stream failed
+            await flush()
+            await self.db.commit()
+        
+        self.append(SelfMessage(content, calls))
     
-    def push(self, role: str, content: str):
-        self.db.add_message(self.id, role, content)
+    async def push(self, role: str, content: str):
+        await self.db.add_message(self.id, role, content)
         match role:
             case "user":
-                self.messages.append(UserMessage(content))
+                self.append(UserMessage(content))
             case "self":
-                self.messages.append(SelfMessage(content, []))
+                self.append(SelfMessage(content, []))
             case _: raise NotImplementedError(role)
 
 class Model:
     def __init__(self, client: ollama.AsyncClient):
         self.client = client
     
-    async def chat(self, system: str, messages: list[ChatMessage]) -> AsyncIterator[ModelOutput]:
-        res = await self.client.chat(
-            model="llama3.1",
-            messages=list(_convo_to_ollama(system, messages)),
-            tools=TOOLS,
-            stream=True
-        )
+    async def warm(self):
+        '''Load the model ahead of the first turn, if ollama is up.'''
+        try:
+            await self.client.generate(
+                model=MODEL, prompt="", keep_alive=KEEP_ALIVE
+            )
+        except Exception as e:
+            log.warning("Failed to warm %s: %r", MODEL, e)
+    
+    async def close(self):
+        # ollama doesn't expose closing its httpx client
+        await self.client._client.aclose()
+    
+    async def chat(self, messages: list[ollama.Message]) -> AsyncIterator[ModelOutput]:
+        # Copy so later turns can't mutate a request still being sent
+        res = await self.client.chat(messages=list(messages), **CHAT_KWARGS)
         async for m in res:
             if msg := m.get('message'):
                 if (chunk := msg.get('content')) is not None:
                     yield Chunk(chunk)
                 elif (calls := msg.get('tool_calls')) is not None:
-                    print(calls)
+                    log.debug("tool calls %r", calls)
                     for call in calls:
                         yield ToolCall(call['name'], call['args'])
                 else:
@@ -336,38 +582,61 @@ class Model:
             else:
                 raise NotImplementedError(m)
 
-@dataclass
+def tune_socket(sock):
+    '''Give sockets room to buffer bursts of small JSONL frames.'''
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUFFER)
+
+@dataclass(slots=True)
 class Result:
     result: Any
 
 type Update = ModelOutput|Result
 
 class Server:
+    __slots__ = ("path", "model", "db", "server", "clients", "warming")
+    
     def __init__(self, path: str, model: Model, db: Database):
         self.path = path
         self.model = model
         self.db = db
+        self.clients: dict[asyncio.Task, "Session"] = {}
     
     async def __aenter__(self):
         self.server = await asyncio.start_unix_server(
             self.on_client,
-            self.path
+            self.path,
+            limit=LINE_LIMIT
         )
+        for sock in self.server.sockets:
+            tune_socket(sock)
         self.db = await Database("private/ezra.db").__aenter__()
+        # Don't hold up startup on ollama
+        self.warming = asyncio.create_task(self.model.warm())
         return self
     
     async def __aexit__(self, *exc):
+        self.warming.cancel()
         self.server.close()
+        # Give in-flight turns a chance to finish before cutting them off
+        turns = [s.turn for s in self.clients.values() if s.turn is not None]
+        if turns:
+            await asyncio.wait(turns, timeout=SHUTDOWN_GRACE)
+        clients = list(self.clients)
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
         await self.server.wait_closed()
         del self.server
         await self.db.__aexit__()
+        await self.model.close()
     
     async def use_tool(self, name: str, *args):
         return "Tools to be implemented."
     
     async def think(self, convo: Conversation) -> AsyncIterator[Update]:
         stream = convo.stream("self",
-            self.model.chat(convo.system, convo.messages)
+            self.model.chat(convo.ollama_messages)
         )
         try:
             res = None
@@ -385,138 +654,272 @@ class Server:
         except StopAsyncIteration:
             pass
     
-    async def handle_client(self, stream: JSONLStream):
-        convo = None
-        while not stream.eof():
-            data = await stream.read()
-            print("recv", data)
-            match data:
-                case {"cmd": "close"}:
-                    break
-                
-                case {"cmd": "list"}:
-                    await stream.write({
-                        "type": "result",
-                        "convos": [
-                            {
-                                "id": c.id,
-                                "summary": c.summary
-                            } for c in self.db.list_convo()
-                        ]
-                    })
-                
-                case {"cmd": "replay", "convo": cid}:
-                    if c := self.db.get_convo(cid):
-                        await stream.write({
-                            "type": "replay",
-                            "system": c.system,
-                            "messages": list(_messages_to_json(
-                                _convo_to_messages(
-                                    self.db.list_chat(cid)
-                                )
-                            ))
-                        })
-                    else:
-                        await stream.write({
-                            "type": "error",
-                            "message": "Unknown conversation"
-                        })
-                
-                case {"cmd": "connect", "convo": cid}:
-                    if c := self.db.get_convo(cid):
-                        convo = Conversation(self.db, cid)
+    async def forward(self, stream: BufferedJSONLStream, convo: Conversation):
+        '''
+        Stream a response to the client, merging tokens into one chunk
+        frame per CHUNK_FRAME_DELAY or CHUNK_FRAME_TOKENS.
+        '''
+        loop = asyncio.get_running_loop()
+        pending: list[str] = []
+        timer: Optional[asyncio.TimerHandle] = None
+        
+        def send_pending():
+            nonlocal timer
+            if timer is not None:
+                timer.cancel()
+                timer = None
+            if pending:
+                stream.write_nowait({
+                    "type": "chunk",
+                    "content": ''.join(pending)
+                })
+                pending.clear()
+        
+        try:
+            async for chunk in self.think(convo):
+                match chunk:
+                    case Chunk(text):
+                        pending.append(text)
+                        if len(pending) >= CHUNK_FRAME_TOKENS:
+                            send_pending()
+                        elif timer is None:
+                            timer = loop.call_later(
+                                CHUNK_FRAME_DELAY, send_pending
+                            )
+                    
+                    case ToolCall(name, args):
+                        send_pending()
                         await stream.write({
-                            "type": "replay",
-                            "system": c.system,
-                            "messages": list(_messages_to_json(convo.messages))
+                            "type": "tool",
+                            "name": name,
+                            "args": args
                         })
-                    else:
+                    
+                    case Result(result):
+                        send_pending()
                         await stream.write({
-                            "type": "error",
-                            "message": "Unknown conversation"
+                            "type": "result",
+                            "result": result
                         })
-                
-                case {"message": message}:
-                    if convo is None:
-                        cid = self.db.start_convo(SYSTEM)
-                        convo = Conversation(self.db, cid)
                     
-                    convo.push("user", message)
-                    
-                    async for chunk in self.think(convo):
-                        match chunk:
-                            case Chunk(text):
-                                await stream.write({
-                                    "type": "chunk",
-                                    "content": text
-                                })
-                            
-                            case ToolCall(name, args):
-                                await stream.write({
-                                    "type": "tool",
-                                    "name": name,
-                                    "args": args
-                                })
-                            
-                            case Result(result):
-                                await stream.write({
-                                    "type": "result",
-                                    "result": result
-                                })
-                            
-                            case _: assert_never(chunk)
-                    
-                    await stream.write({
-                        "type": "done"
-                    })
-                
-                case _:
-                    await stream.write({
-                        "type": "error",
-                        "message": "Unknown request type"
-                    })
+                    case _: assert_never(chunk)
+        finally:
+            send_pending()
+        
+        await stream.write({
+            "type": "done"
+        })
+        await stream.flush()
     
-    async def on_client(self, r, w):
-        async with JSONLStream(r, w) as stream:
+    async def handle_client(self, session: "Session"):
+        stream = session.stream
+        requests: asyncio.Queue[Optional[Any]] = asyncio.Queue()
+        
+        async def receive():
+            '''Keep reading requests while a response is streaming.'''
             try:
-                await self.handle_client(stream)
-            except ConnectionResetError:
+                while (data := await stream.read()) is not None:
+                    requests.put_nowait(data)
+            except ConnectionError:
                 pass
-            except Exception:
-                tb.print_exc()
-                await stream.write({
-                    "type": "uncaught",
-                    "traceback": tb.format_exc()
+            finally:
+                # Nobody's left to stream a response to
+                if session.turn is not None:
+                    session.turn.cancel()
+                requests.put_nowait(None)
+        
+        async with asyncio.TaskGroup() as tg:
+            receiver = tg.create_task(receive())
+            try:
+                await self.dispatch(session, requests)
+            finally:
+                receiver.cancel()
+    
+    async def dispatch(self, session: "Session", requests: asyncio.Queue[Optional[Any]]):
+        while (data := await requests.get()) is not None:
+            log.debug("recv %r", data)
+            cmd = data.get("cmd", "message") if isinstance(data, dict) else None
+            if handler := COMMANDS.get(cmd):
+                if await handler(self, session, data):
+                    break
+            else:
+                await session.stream.write({
+                    "type": "error",
+                    "message": "Unknown request type"
                 })
+    
+    async def cmd_close(self, session: "Session", data: dict):
+        return True
+    
+    async def cmd_list(self, session: "Session", data: dict):
+        await session.stream.write({
+            "type": "result",
+            "convos": [
+                {
+                    "id": c.id,
+                    "summary": c.summary
+                } for c in await self.db.list_convo()
+            ]
+        })
+    
+    async def cmd_replay(self, session: "Session", data: dict):
+        cid = data.get("convo")
+        if c := await self.db.get_convo(cid):
+            await session.stream.write({
+                "type": "replay",
+                "system": c.system,
+                "messages": _messages_to_jsonable(
+                    _convo_to_messages(
+                        await self.db.list_chat(cid)
+                    )
+                )
+            })
+        else:
+            await session.stream.write({
+                "type": "error",
+                "message": "Unknown conversation"
+            })
+    
+    async def cmd_connect(self, session: "Session", data: dict):
+        cid = data.get("convo")
+        if c := await self.db.get_convo(cid):
+            session.convo = convo = await Conversation.load(self.db, c)
+            await session.stream.write({
+                "type": "replay",
+                "system": c.system,
+                "messages": _messages_to_jsonable(convo.messages)
+            })
+        else:
+            await session.stream.write({
+                "type": "error",
+                "message": "Unknown conversation"
+            })
+    
+    async def cmd_message(self, session: "Session", data: dict):
+        if (message := data.get("message")) is None:
+            await session.stream.write({
+                "type": "error",
+                "message": "Unknown request type"
+            })
+            return
+        
+        if (convo := session.convo) is None:
+            cid = await self.db.start_convo(SYSTEM)
+            session.convo = convo = Conversation(
+                self.db, ConvoRow(cid, None, SYSTEM)
+            )
+        
+        await convo.push("user", message)
+        # Tracked so shutdown can wait on it
+        session.turn = asyncio.create_task(self.forward(session.stream, convo))
+        try:
+            await session.turn
+        except asyncio.CancelledError:
+            # The client hung up mid-turn, so close the connection
+            if (task := asyncio.current_task()) and task.cancelling():
                 raise
+            return True
+        finally:
+            session.turn = None
+    
+    async def on_client(self, r, w):
+        tune_socket(w.get_extra_info('socket'))
+        task = asyncio.current_task()
+        try:
+            async with BufferedJSONLStream(r, w) as stream:
+                session = Session(stream)
+                if task:
+                    self.clients[task] = session
+                try:
+                    await self.handle_client(session)
+                except* ConnectionError:
+                    pass
+                except* Exception:
+                    tb.print_exc()
+                    await stream.write({
+                        "type": "uncaught",
+                        "traceback": tb.format_exc()
+                    })
+                    raise
+        finally:
+            if task:
+                self.clients.pop(task, None)
     
     async def run(self):
         await self.server.serve_forever()
 
+@dataclass(slots=True)
+class Session:
+    '''Per-connection client state.'''
+    stream: BufferedJSONLStream
+    convo: Optional[Conversation] = None
+    # Response currently being streamed, if any
+    turn: Optional[asyncio.Task] = None
+
+# Request handlers by "cmd", returning True to close the connection
+COMMANDS: dict[Optional[str], Callable[[Server, Session, dict], Awaitable[Optional[bool]]]] = {
+    "close": Server.cmd_close,
+    "list": Server.cmd_list,
+    "replay": Server.cmd_replay,
+    "connect": Server.cmd_connect,
+    "message": Server.cmd_message,
+}
+
 async def run(server: Server):
-    stop_event = asyncio.Event()
-    def handle_signal():
-        stop_event.set()
-        raise KeyboardInterrupt
-    
-    async with asyncio.TaskGroup() as tg:
-        if loop := tg._loop:
-            loop.add_signal_handler(signal.SIGINT, handle_signal)
-            loop.add_signal_handler(signal.SIGTERM, handle_signal)
-        
-        async with server:
-            st = asyncio.create_task(server.run())
-            await stop_event.wait()
-            st.cancel()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    
+    async with server:
+        serving = asyncio.create_task(server.run())
+        stopping = asyncio.create_task(stop.wait())
+        await asyncio.wait(
+            [serving, stopping],
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        serving.cancel()
+        stopping.cancel()
+        served, _ = await asyncio.gather(
+            serving, stopping, return_exceptions=True
+        )
+        # Cancellation is how we stop it, anything else is a real failure
+        if isinstance(served, Exception):
+            raise served
+
+def loop_factory() -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    '''Use uvloop's faster transports when it's installed.'''
+    try:
+        import uvloop
+        return uvloop.new_event_loop
+    except ImportError:
+        return None
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log requests and tool calls")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.verbose:
+        # Only ours, asyncio and httpx are far too chatty at DEBUG
+        log.setLevel(logging.DEBUG)
+    
     try:
-        client = ollama.AsyncClient("theseus.home.arpa")
+        # httpx drops idle connections after 5s by default, which is
+        #  shorter than the time between turns
+        client = ollama.AsyncClient("theseus.home.arpa",
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=KEEPALIVE_EXPIRY
+            )
+        )
         model = Model(client)
         memory = Database("private/ezra.db")
         server = Server("private/ezra.sock", model, memory)
         
-        asyncio.run(run(server))
+        asyncio.run(run(server), loop_factory=loop_factory())
     except KeyboardInterrupt:
         pass
 
@@ -1,8 +1,35 @@
 from typing import Any, Protocol
 import asyncio
-import json
+
+try:
+    import orjson
+    
+    def dumps(data: Any) -> bytes:
+        return orjson.dumps(data)
+    
+    def dumpl(data: Any) -> bytes:
+        '''Encode a JSONL line, newline included.'''
+        return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    
+    loads = orjson.loads
+except ImportError:
+    import json
+    
+    def dumps(data: Any) -> bytes:
+        return json.dumps(data).encode('utf8')
+    
+    def dumpl(data: Any) -> bytes:
+        '''Encode a JSONL line, newline included.'''
+        return (json.dumps(data) + '\n').encode('utf8')
+    
+    loads = json.loads
+
+# StreamReader buffer limit, large enough for most replays
+LINE_LIMIT = 2**20
 
 class JSONLStream:
+    __slots__ = ("reader", "writer")
+    
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         self.reader = reader
         self.writer = writer
@@ -14,25 +41,106 @@ class JSONLStream:
         await self.close()
     
     async def close(self):
-        await self.writer.drain()
-        self.writer.close()
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # Peer's already gone, nothing left to flush
+            pass
+        finally:
+            self.writer.close()
     
     def eof(self):
         return self.reader.at_eof()
     
     async def read(self):
-        buf = b''
-        while c := await self.reader.read(1):
-            buf += c
-            if c == b'\n':
-                break
+        '''Read the next line, or None at EOF.'''
+        try:
+            buf = await self.reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            buf = e.partial
+        except asyncio.LimitOverrunError as e:
+            buf = await self.read_long(e.consumed)
         if buf:
-            return json.loads(buf.decode('utf8'))
-        raise ConnectionResetError
+            return loads(buf)
+        return None
     
-    async def write(self, data):
-        self.writer.write((json.dumps(data) + '\n').encode('utf8'))
+    async def read_long(self, consumed: int) -> bytes:
+        '''Read a line longer than the reader's buffer limit.'''
+        buf = bytearray()
+        while True:
+            buf += await self.reader.readexactly(consumed)
+            try:
+                buf += await self.reader.readuntil(b'\n')
+                return bytes(buf)
+            except asyncio.IncompleteReadError as e:
+                buf += e.partial
+                return bytes(buf)
+            except asyncio.LimitOverrunError as e:
+                consumed = e.consumed
+    
+    async def flush(self):
         await self.writer.drain()
+    
+    async def backpressure(self):
+        '''
+        Only wait on the transport once its buffer is backed up, or once
+        it's closing so a dead peer raises on the next write.
+        '''
+        transport = self.writer.transport
+        if transport.is_closing() or (
+            transport.get_write_buffer_size() > transport.get_write_buffer_limits()[1]
+        ):
+            await self.writer.drain()
+    
+    async def write_raw(self, data: bytes):
+        '''Write an already-encoded JSON line.'''
+        self.writer.write(data)
+        await self.backpressure()
+    
+    async def write(self, data):
+        await self.write_raw(dumpl(data))
+    
+class BufferedJSONLStream(JSONLStream):
+    '''
+    JSONL stream which coalesces lines written with `write_nowait` into a
+    single transport write per event loop iteration.
+    '''
+    
+    __slots__ = ("buffer", "scheduled")
+    
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        super().__init__(reader, writer)
+        self.buffer = bytearray()
+        self.scheduled = False
+    
+    def _write_buffer(self):
+        self.scheduled = False
+        if self.writer.transport.is_closing():
+            # Peer's gone, the next awaited write raises instead
+            self.buffer.clear()
+        elif self.buffer:
+            # The transport may keep a view of the buffer, so don't reuse it
+            buf, self.buffer = self.buffer, bytearray()
+            self.writer.write(buf)
+    
+    def write_nowait(self, data):
+        self.buffer += dumpl(data)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self._write_buffer)
+    
+    async def flush(self):
+        self._write_buffer()
+        await super().flush()
+    
+    async def write_raw(self, data: bytes):
+        self.buffer += data
+        self._write_buffer()
+        await self.backpressure()
+    
+    async def close(self):
+        self._write_buffer()
+        await super().close()
 
 class ToString(Protocol):
     def __str__(self) -> str: ...